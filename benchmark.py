@@ -0,0 +1,270 @@
+"""
+Offline benchmark for today.py. A local stub server stands in for the GitHub GraphQL API and committers.top,
+synthesising paginated repositories, commit histories, contribution calendars and rank badges, with optional
+latency and secondary rate limit 403s. Every scenario runs cold (empty cache/) and then warm (after a share of the
+repos gained commits), and reports wall time, HTTP requests, retries and peak memory per stage.
+
+    python benchmark.py
+    python benchmark.py --repos 10,200,1000 --commits 5000,100000 --latency 20 --error-rate 0.01 --json bench.json
+"""
+import argparse
+import datetime
+import hashlib
+import http.server
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import requests
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+OWNER_LOGIN = 'bench'
+OWNER_ID = 'U_bench'
+BASE_DATE = datetime.datetime(2020, 1, 1)
+LANGUAGES = [('Python', '#3572A5'), ('JavaScript', '#f1e05a'), ('TypeScript', '#3178c6'), ('Go', '#00ADD8'),
+             ('Rust', '#dea584'), ('Shell', '#89e051'), ('HTML', '#e34c26'), ('CSS', '#563d7c')]
+STAGES = ['loc', 'streak', 'languages', 'rank', 'svg']
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers the queries today.py sends, told apart by the fields they select. Commit k of a repo (0 is the oldest)
+    is authored by the owner when k % 3 == 0, so histories of any length are computed per page, never stored
+    """
+    protocol_version = 'HTTP/1.1'
+    state = None  # {'repos': {name: [commit count, pushedAt]}, 'latency', 'error_rate', 'random'}
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=()):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        time.sleep(self.state['latency'])
+        self.reply(200, '<svg><text>Rank #1,234</text></svg>', [('Content-Type', 'image/svg+xml')])
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path.startswith('/_'):
+            control(self.state, self.path, payload)
+            return self.reply(200, '{}')
+        time.sleep(self.state['latency'])
+        if self.state['random'].random() < self.state['error_rate']:
+            return self.reply(403, '{"message": "You have exceeded a secondary rate limit."}', [('Retry-After', '0')])
+        data = graphql_data(self.state['repos'], payload['query'], payload['variables'])
+        data['rateLimit'] = {'cost': 1, 'remaining': 4999, 'resetAt': '2099-01-01T00:00:00Z'}
+        self.reply(200, json.dumps({'data': data}), [('Content-Type', 'application/json')])
+
+
+def control(state, path, payload):
+    """/_reset builds a fresh set of repos; /_grow adds commits to a share of them, as if they had been pushed to"""
+    if path == '/_reset':
+        state['repos'] = {f"{OWNER_LOGIN}/repo{index}": [payload['commits'], BASE_DATE.isoformat() + 'Z']
+                          for index in range(payload['repos'])}
+    elif path == '/_grow':
+        pushed = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z'
+        for name in sorted(state['repos'])[:max(1, int(len(state['repos']) * payload['share']))]:
+            state['repos'][name] = [state['repos'][name][0] + payload['commits'], pushed]
+
+
+def commit_date(k):
+    return (BASE_DATE + datetime.timedelta(minutes=k)).isoformat() + 'Z'
+
+
+def graphql_data(repos, query, variables):
+    if 'languages(' in query:
+        return {'r' + key[1:]: {'languages': {'edges': repo_languages(value + '/' + variables['n' + key[1:]])}}
+                for key, value in variables.items() if key.startswith('o')}
+    if 'repository(name' in query:
+        return {'repository': history_page(repos, variables)}
+    if 'followers' in query:
+        return summary_data(repos, variables)
+    if 'contributionsCollection' in query:
+        return {'user': {key[:-5]: calendar_data(value[:4]) for key, value in variables.items()
+                         if key.endswith('_from')}}
+    return {'user': {'repositories': inventory_page(repos, variables)}}
+
+
+def history_page(repos, variables):
+    """One page of the owner's commits, newest first, optionally limited to those committed since `since`"""
+    commits = repos[variables['owner'] + '/' + variables['repo_name']][0]
+    owned = (commits + 2) // 3
+    first = 0
+    if variables.get('since'):
+        since = datetime.datetime.fromisoformat(variables['since'].rstrip('Z'))
+        first = max(0, (int((since - BASE_DATE).total_seconds() // 60) + 2) // 3)
+    total = max(0, owned - first)
+    offset = int(variables.get('cursor') or 0)
+    edges = []
+    for index in range(offset, min(offset + 100, total)):
+        k = 3 * (owned - 1 - index)
+        edges.append({'node': {'oid': hashlib.sha1(f"{variables['repo_name']}:{k}".encode()).hexdigest(),
+                               'committedDate': commit_date(k), 'additions': k % 50 + 1, 'deletions': k % 5}})
+    history = {'totalCount': total, 'edges': edges,
+               'pageInfo': {'endCursor': str(offset + 100), 'hasNextPage': offset + 100 < total}}
+    return {'defaultBranchRef': {'target': {'history': history}}}
+
+
+def inventory_page(repos, variables):
+    names = sorted(repos)
+    offset = int(variables.get('cursor') or 0)
+    nodes = []
+    for name in names[offset:offset + 100]:
+        commits, pushed = repos[name]
+        nodes.append({'nameWithOwner': name, 'owner': {'login': OWNER_LOGIN},
+                      'stargazerCount': int(name.rsplit('repo', 1)[1]) % 7, 'pushedAt': pushed,
+                      'defaultBranchRef': {'target': {'history': {'totalCount': (commits + 2) // 3}}}})
+    return {'totalCount': len(names), 'nodes': nodes,
+            'pageInfo': {'endCursor': str(offset + 100), 'hasNextPage': offset + 100 < len(names)}}
+
+
+def repo_languages(name):
+    index = int(name.rsplit('repo', 1)[1])
+    return [{'size': 1000 * (index % 13 + 1) // (rank + 1),
+             'node': dict(zip(['name', 'color'], LANGUAGES[(index + rank) % len(LANGUAGES)]))}
+            for rank in range(index % 4 + 1)]
+
+
+def calendar_data(year):
+    days = []
+    day = datetime.date(int(year), 1, 1)
+    while day.year == int(year) and day <= datetime.date.today():
+        days.append({'date': day.isoformat(), 'contributionCount': (day.toordinal() * 7) % 5})
+        day += datetime.timedelta(days=1)
+    return {'contributionCalendar': {'totalContributions': sum(day['contributionCount'] for day in days),
+                                     'weeks': [{'contributionDays': days[week:week + 7]}
+                                               for week in range(0, len(days), 7)]}}
+
+
+def summary_data(repos, variables):
+    latest = max((pushed for __, pushed in repos.values()), default=None)
+    return {'user': {'id': OWNER_ID, 'followers': {'totalCount': 42},
+                     'contributionsCollection': calendar_data(variables['from'][:4]),
+                     'recent': {'totalCount': len(repos), 'nodes': [{'pushedAt': latest}] if latest else []},
+                     'starred': {'nodes': [{'stargazerCount': int(name.rsplit('repo', 1)[1]) % 7}
+                                           for name in sorted(repos)[:100]]}}}
+
+
+def serve(port_pipe, latency, error_rate):
+    StubHandler.state = {'repos': {}, 'latency': latency, 'error_rate': error_rate, 'random': random.Random(0)}
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    port_pipe.send(server.server_address[1])
+    server.serve_forever()
+
+
+def run_stage(today, funct, *args, memory=True):
+    """Run one stage under a fresh tracer; returns (result, {wall, requests, retries, peak_mb})"""
+    today.TRACER = today.Tracer()
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = funct(*args)
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20 if memory else None
+    if memory:
+        tracemalloc.stop()
+    http = [span for span in today.TRACER.spans if span['kind'] == 'http']
+    return result, {'wall': wall, 'requests': len(http), 'retries': sum(span.get('retries', 0) for span in http),
+                    'peak_mb': peak}
+
+
+def run_scenario(today, memory):
+    """One pass over the measured stages in the current directory, sharing the cache/ left by earlier passes"""
+    today.SCHEDULERS.clear()
+    today.SHARED.clear()
+    profile = today.Profile(OWNER_LOGIN, 'bench', '2000-01-01')
+    profile.owner_id = {'id': OWNER_ID}
+    inventory = {}
+    metrics = {}
+    total_loc, metrics['loc'] = run_stage(
+        today, lambda: today.loc_query(profile, today.inventory_pages(
+            profile, ['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'], inventory), 7), memory=memory)
+    streak, metrics['streak'] = run_stage(today, lambda: today.get_streak_stats(today.calendar_refresh(profile)),
+                                          memory=memory)
+    languages, metrics['languages'] = run_stage(today, today.top_languages_getter, profile, inventory,
+                                                memory=memory)
+    rank, metrics['rank'] = run_stage(today, today.committers_rank_getter, profile, memory=memory)
+    loc_data = ['{:,}'.format(value) for value in total_loc[:-1]]
+    values = today.svg_values('20 years', '1,000', 100, rank, len(inventory), len(inventory), 42, loc_data,
+                              languages, streak)
+    __, metrics['svg'] = run_stage(today, today.svg_render, profile, values, memory=memory)
+    return metrics
+
+
+def stub_post(url, payload):
+    requests.post(url, json=payload, timeout=30).raise_for_status()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the today.py stages against a local stub')
+    parser.add_argument('--repos', default='10,200', help='comma-separated repo counts (default: 10,200)')
+    parser.add_argument('--commits', default='5000', help='comma-separated commits per repo (default: 5000)')
+    parser.add_argument('--latency', type=float, default=0, help='stub response latency in ms (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of GraphQL requests answered with a '
+                                                                     'secondary rate limit 403 (default: 0)')
+    parser.add_argument('--grow-share', type=float, default=0.1, help='share of repos pushed to before the warm '
+                                                                      'run (default: 0.1)')
+    parser.add_argument('--grow-commits', type=int, default=50, help='commits pushed to each of them (default: 50)')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows every stage down')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    parent_pipe, child_pipe = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child_pipe, args.latency / 1000, args.error_rate),
+                                     daemon=True)
+    server.start()
+    base = 'http://127.0.0.1:%d' % parent_pipe.recv()
+    os.environ.update({'ACCESS_TOKEN': 'bench', 'USER_NAME': OWNER_LOGIN, 'GRAPHQL_URL': base + '/graphql',
+                       'COMMITTERS_URL': base, 'REQUEST_BACKOFF': '0.01'})
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    today = importlib.import_module('today')
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    results = []
+    print('{:<22}{:<7}{:<11}{:>10}{:>10}{:>9}{:>11}'.format('scenario', 'cache', 'stage', 'wall s', 'requests',
+                                                          'retries', 'peak MB'))
+    for repos in [int(value) for value in args.repos.split(',')]:
+        for commits in [int(value) for value in args.commits.split(',')]:
+            workdir = tempfile.mkdtemp(prefix='today-bench-')
+            os.makedirs(os.path.join(workdir, 'cache'))
+            for filename in ['dark_mode.svg', 'light_mode.svg']:
+                shutil.copy(os.path.join(here, filename), workdir)
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                today.SVG_TEMPLATES.clear()
+                stub_post(base + '/_reset', {'repos': repos, 'commits': commits})
+                for cache in ['cold', 'warm']:
+                    if cache == 'warm':
+                        stub_post(base + '/_grow', {'share': args.grow_share, 'commits': args.grow_commits})
+                    metrics = run_scenario(today, not args.no_memory)
+                    scenario = '%d repos x %d' % (repos, commits)
+                    for stage in STAGES:
+                        metric = metrics[stage]
+                        print('{:<22}{:<7}{:<11}{:>10.4f}{:>10}{:>9}{:>11}'.format(
+                            scenario, cache, stage, metric['wall'], metric['requests'], metric['retries'],
+                            '-' if metric['peak_mb'] is None else '%.2f' % metric['peak_mb']))
+                        results.append(dict(metric, repos=repos, commits=commits, cache=cache, stage=stage))
+            finally:
+                os.chdir(cwd)
+                shutil.rmtree(workdir)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'latency_ms': args.latency, 'error_rate': args.error_rate, 'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,82 @@
+import atexit
+import base64
+import contextlib
 import datetime
 from dateutil import relativedelta
 import requests
 import os
+import queue
+import random
 from lxml import etree
 import time
 import hashlib
+import heapq
+import hmac
+import http.server
+import json
+import multiprocessing
 import re
-
-HEADERS = {'authorization': 'token ' + os.environ['ACCESS_TOKEN']}
-USER_NAME = os.environ['USER_NAME']
-QUERY_COUNT = {'user_getter': 0, 'follower_getter': 0, 'graph_repos_stars': 0, 'recursive_loc': 0, 'graph_commits': 0,
-               'loc_query': 0}
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
+USER_NAME = os.environ.get('USER_NAME', '')
+# JSON list of profiles to render in one process instead of USER_NAME, each {"login", "birthday": "YYYY-MM-DD"} plus
+# optional "templates", "country", "git_authors" and "token_env" (the variable holding its token, ACCESS_TOKEN if unset)
+BATCH_FILE = os.environ.get('BATCH_FILE', '')
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 4))  # profiles rendered at once in batch mode
+GRAPHQL_URL = os.environ.get('GRAPHQL_URL', 'https://api.github.com/graphql')
+COMMITTERS_URL = os.environ.get('COMMITTERS_URL', 'https://user-badge.committers.top')
+CONTRIB_START_YEAR = 2020
+CONTRIB_WINDOWS_PER_QUERY = 5  # yearly calendars per aliased request, keeps each query well under the cost limit
+LANGUAGES_PER_QUERY = 50  # repositories per aliased language request
+LOC_WORKERS = int(os.environ.get('LOC_WORKERS', 8))  # concurrent repository crawls in cache_builder
+LOC_RESUME_ATTEMPTS = int(os.environ.get('LOC_RESUME_ATTEMPTS', 2))  # in-run resumes of a failed repo crawl
+LOC_RESUME_DELAY = int(os.environ.get('LOC_RESUME_DELAY', 60))  # seconds to wait before resuming
+CHECKPOINT_LOCK = threading.Lock()
+LOC_BACKEND = os.environ.get('LOC_BACKEND', 'graphql')  # 'graphql' pages commit history, 'git' reads local clones
+LOC_CLONE_DIR = os.environ.get('LOC_CLONE_DIR', 'clones')  # bare clones for the git backend, kept between runs
+LOC_GIT_URL = os.environ.get('LOC_GIT_URL', 'https://github.com')
+LOC_GIT_AUTHORS = os.environ.get('LOC_GIT_AUTHORS', USER_NAME).split(',')  # git --author patterns for USER_NAME
+FORCE_REFRESH = os.environ.get('FORCE_REFRESH', '') not in ('', '0')  # rerun every stage despite the probe
+TEMPLATES = ('dark_mode.svg', 'light_mode.svg')
+SVG_TEMPLATES = {}  # filename -> (mtime_ns, parsed tree, {id: element})
+RANK_TTL = int(os.environ.get('RANK_TTL', 6 * 3600))  # seconds a fetched committers.top rank stays fresh
+RANK_DEADLINE = int(os.environ.get('RANK_DEADLINE', 20))  # seconds the committers.top endpoints get, retries included
+SERVE_PORT = int(os.environ.get('SERVE_PORT', 0))  # when set, keep running: serve the cards and refresh them in place
+SERVE_HOST = os.environ.get('SERVE_HOST', '127.0.0.1')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')  # verifies X-Hub-Signature-256 on push triggers when set
+STAT_TTLS = {  # seconds each stat is served from memory before the service refreshes it, in refresh order
+    'summary': int(os.environ.get('SUMMARY_TTL', 900)),
+    'calendar': int(os.environ.get('CALENDAR_TTL', 3600)),
+    'rank': RANK_TTL,
+    'loc': int(os.environ.get('LOC_TTL', 6 * 3600))
+}
+STAT_RETRY = 300  # seconds before a failed refresh is tried again
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 30))  # seconds, per HTTP request
+REQUEST_RETRIES = int(os.environ.get('REQUEST_RETRIES', 4))  # retries on connection errors, 5xx and secondary limits
+REQUEST_BACKOFF = float(os.environ.get('REQUEST_BACKOFF', 1))  # base seconds of the exponential backoff
+TRACE_FILE = os.environ.get('TRACE_FILE', '')  # write the run's spans here as JSON, when set
+
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', max(LOC_WORKERS, 10)))  # across all profiles
+
+# One pooled keep-alive session for every API call of every profile. Requests in flight are capped at the pool size,
+# so a batch of profiles queues for sockets instead of opening more
+SESSION = requests.Session()
+SESSION.headers['Accept-Encoding'] = 'gzip, deflate'
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_REQUESTS))
+REQUEST_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+SHARED = {}  # key -> Future of work done once per run for every profile, see shared()
+SHARED_LOCK = threading.Lock()
+GIT_POOL = []  # the git backend's process pool, created on first use
+GIT_POOL_LOCK = threading.Lock()
+
+PRIORITY_FOREGROUND, PRIORITY_BACKGROUND = 0, 1  # summary stats vs. the LOC crawl
+RATE_LIMIT_RESERVE = int(os.environ.get('RATE_LIMIT_RESERVE', 200))  # points the LOC crawl leaves for everything else
+RATE_LIMIT_PACE_BELOW = int(os.environ.get('RATE_LIMIT_PACE_BELOW', 1000))  # start spacing queries out below this
+RATE_LIMIT_MAX_WAIT = int(os.environ.get('RATE_LIMIT_MAX_WAIT', 3900))  # give up rather than sleep longer than this
 
 
 def daily_readme(birthday):
@@ -26,104 +92,411 @@ def format_plural(unit):
     return 's' if unit != 1 else ''
 
 
-def simple_request(func_name, query, variables):
-    request = requests.post('https://api.github.com/graphql', json={'query': query, 'variables': variables},
-                            headers=HEADERS)
+class Tracer:
+    """
+    Records spans for the pipeline stages, repo crawls, GraphQL queries and HTTP requests. A span is a dict with its
+    kind, name, start offset and duration in seconds, the id of the span it ran inside and whatever attributes the
+    instrumented code sets on it. Spans nest per thread; work handed to another thread is linked with bind()
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.started = datetime.datetime.utcnow().isoformat() + 'Z'
+        self.spans = []
+        self.next_id = 0
+
+    def current(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def span(self, kind, name, **attributes):
+        parent = self.current()
+        record = dict(attributes, kind=kind, name=name, parent=parent['id'] if parent else None,
+                      thread=threading.current_thread().name, start=time.perf_counter() - self.origin)
+        with self.lock:
+            record['id'] = self.next_id
+            self.next_id += 1
+            self.spans.append(record)
+        self.local.stack = getattr(self.local, 'stack', []) + [record]
+        try:
+            yield record
+        except BaseException as error:
+            record['error'] = type(error).__name__ + ': ' + str(error)
+            raise
+        finally:
+            record['duration'] = time.perf_counter() - self.origin - record['start']
+            self.local.stack = self.local.stack[:-1]
+
+    def annotate(self, **attributes):
+        """Set attributes on the innermost open span of the calling thread"""
+        if self.current() is not None:
+            self.current().update(attributes)
+
+    def bind(self, funct):
+        """Wrap funct so its spans nest under the caller's current span from whichever thread it runs on"""
+        parent = self.current()
+
+        def bound(*args, **kwargs):
+            stack, self.local.stack = getattr(self.local, 'stack', []), [parent] if parent else []
+            try:
+                return funct(*args, **kwargs)
+            finally:
+                self.local.stack = stack
+        return bound
+
+    def drain(self, root):
+        """Remove and return a finished span with everything under it, so a long-running process never piles them up"""
+        with self.lock:
+            tree = {root['id']}
+            for span in self.spans:
+                if span['parent'] in tree:
+                    tree.add(span['id'])
+            drained = [span for span in self.spans if span['id'] in tree]
+            self.spans = [span for span in self.spans if span['id'] not in tree]
+        return drained
+
+    def totals(self, kind):
+        """{name: [span count, total seconds, total GraphQL cost]} over the finished spans of one kind"""
+        totals = {}
+        with self.lock:
+            spans = [span for span in self.spans if span['kind'] == kind and 'duration' in span]
+        for span in spans:
+            total = totals.setdefault(span['name'], [0, 0.0, 0])
+            total[0] += 1
+            total[1] += span['duration']
+            total[2] += span.get('cost') or 0
+        return totals
+
+    def dump(self, filename, **extra):
+        with self.lock:
+            spans = [dict(span) for span in self.spans]
+        atomic_write(filename, json.dumps(dict(extra, started=self.started, spans=spans), indent=1))
+
+
+TRACER = Tracer()
+
+
+def http_request(method, url, **kwargs):
+    """
+    Send a request through the shared keep-alive session. Connection errors, 5xx responses and secondary rate limits
+    are retried up to REQUEST_RETRIES times with exponential backoff and full jitter, honouring Retry-After
+    """
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    with TRACER.span('http', method + ' ' + url) as span:
+        for attempt in range(REQUEST_RETRIES + 1):
+            span['retries'] = attempt
+            delay = None
+            try:
+                with REQUEST_SLOTS:
+                    response = SESSION.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == REQUEST_RETRIES:
+                    raise
+            else:
+                span['status'] = response.status_code
+                transferred = wire_size(response)
+                if transferred is not None:
+                    span['bytes_transferred'] = transferred
+                secondary_limit = response.status_code in (403, 429) and (
+                    'Retry-After' in response.headers or 'secondary rate limit' in response.text.lower())
+                if not (response.status_code >= 500 or secondary_limit) or attempt == REQUEST_RETRIES:
+                    return response
+                if 'Retry-After' in response.headers and response.headers['Retry-After'].isdigit():
+                    delay = int(response.headers['Retry-After'])
+            time.sleep(delay if delay is not None else random.uniform(0, REQUEST_BACKOFF * 2 ** attempt))
+
+
+def wire_size(response):
+    """
+    Body bytes as sent over the wire, before gzip is undone: Content-Length, else what urllib3 counted while reading,
+    else the body itself if it was not encoded. None for an encoded chunked body, whose wire size urllib3 does not keep
+    """
+    if response.headers.get('Content-Length', '').isdigit():
+        return int(response.headers['Content-Length'])
+    if response.raw is not None and response.raw.tell():
+        return response.raw.tell()
+    if 'Content-Encoding' not in response.headers:
+        return len(response.content)
+    return None
+
+
+class RateLimitScheduler:
+    """
+    Tracks the GraphQL point budget from the rateLimit field and X-RateLimit headers of every response. Background
+    (LOC) queries keep RATE_LIMIT_RESERVE points free for foreground stats, and once the budget drops below
+    RATE_LIMIT_PACE_BELOW all queries are spaced evenly over the time left until the reset
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset_at = 0
+        self.next_slot = 0
+        self.spent = 0
+
+    def wait(self, priority):
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.remaining is None or now >= self.reset_at:
+                    return
+                reserve = RATE_LIMIT_RESERVE if priority == PRIORITY_BACKGROUND else 0
+                if self.remaining <= reserve:
+                    delay, paced = self.reset_at - now, False
+                elif self.remaining < RATE_LIMIT_PACE_BELOW:
+                    slot = max(self.next_slot, now)
+                    self.next_slot = slot + (self.reset_at - now) / (self.remaining - reserve)
+                    self.remaining -= 1
+                    delay, paced = slot - now, True
+                else:
+                    self.remaining -= 1
+                    return
+            if delay > RATE_LIMIT_MAX_WAIT:
+                raise Exception('The GraphQL rate limit is exhausted until',
+                                datetime.datetime.fromtimestamp(self.reset_at).isoformat(), TRACER.totals('query'))
+            if delay > 1:
+                print('Rate limit budget low (' + str(self.remaining), 'points left), waiting', int(delay), 's')
+            time.sleep(max(delay, 0))
+            if paced:
+                return
+
+    def update(self, response):
+        """Take the budget from a response; returns the query's point cost, or None if the response has none"""
+        with self.lock:
+            if 'X-RateLimit-Remaining' in response.headers:
+                self.remaining = int(response.headers['X-RateLimit-Remaining'])
+                self.reset_at = int(response.headers.get('X-RateLimit-Reset', 0))
+            try:
+                rate_limit = response.json()['data']['rateLimit']
+            except (ValueError, KeyError, TypeError):
+                return None
+            self.spent += rate_limit['cost']
+            self.remaining = rate_limit['remaining']
+            self.reset_at = datetime.datetime.fromisoformat(rate_limit['resetAt'].replace('Z', '+00:00')).timestamp()
+            return rate_limit['cost']
+
+    def exhausted(self, response):
+        return response.headers.get('X-RateLimit-Remaining') == '0' and (
+            response.status_code == 403 or 'RATE_LIMITED' in response.text)
+
+
+SCHEDULERS = {}  # token -> RateLimitScheduler, GitHub budgets points per token
+
+
+class Profile:
+    """
+    Everything that belongs to one rendered user, in place of module globals: login, token and the scheduler of that
+    token, the owner id once the summary has it, cache files, templates and the stages served from cache this run
+    """
+
+    def __init__(self, login, token, birthday, templates=TEMPLATES, country='kurdistan',
+                 git_authors=None):
+        self.login = login
+        self.token = token
+        self.headers = {'authorization': 'token ' + token}
+        self.scheduler = SCHEDULERS.setdefault(token, RateLimitScheduler())
+        self.owner_id = None
+        self.templates = list(templates)
+        self.birthday = datetime.datetime.fromisoformat(birthday)
+        self.country = country
+        self.git_authors = git_authors or [login]
+        self.skipped_stages = []
+
+    def cache_file(self, suffix):
+        return 'cache/' + hashlib.sha256(self.login.encode('utf-8')).hexdigest() + suffix
+
+
+def shared(key, funct, *args):
+    """
+    Run funct(*args) once per key for the whole run, whichever profile asks first; callers asking while it runs
+    wait for it, and later callers get the stored result
+    """
+    with SHARED_LOCK:
+        future = SHARED.get(key)
+        first = future is None
+        if first:
+            future = SHARED[key] = Future()
+    if first:
+        try:
+            future.set_result(funct(*args))
+        except BaseException as error:
+            future.set_exception(error)
+    return future.result()
+
+
+def shared_forget():
+    """Drop the finished shared() results, so the next refresh of a long-running process does the work again"""
+    with SHARED_LOCK:
+        for key, future in list(SHARED.items()):
+            if future.done():
+                del SHARED[key]
+
+
+def graphql_post(profile, func_name, query, variables, priority=PRIORITY_FOREGROUND):
+    """
+    POST a GraphQL query once the scheduler allows it, traced as a query span named func_name with the time spent
+    waiting on the scheduler and the point cost. The query's closing brace gets a rateLimit selection so every
+    response reports its cost; a query rejected for an exhausted budget is retried once after the reset
+    """
+    query = query.rstrip()[:-1] + '    rateLimit { cost remaining resetAt }\n    }'
+    with TRACER.span('query', func_name, priority=priority, wait=0.0) as span:
+        for attempt in range(2):
+            start = time.perf_counter()
+            profile.scheduler.wait(priority)
+            span['wait'] += time.perf_counter() - start
+            request = http_request('POST', GRAPHQL_URL, json={'query': query, 'variables': variables},
+                                   headers=profile.headers)
+            span['cost'] = profile.scheduler.update(request)
+            if attempt or not profile.scheduler.exhausted(request):
+                return request
+
+
+def simple_request(profile, func_name, query, variables, priority=PRIORITY_FOREGROUND):
+    request = graphql_post(profile, func_name, query, variables, priority)
     if request.status_code == 200:
         return request
-    raise Exception(func_name, ' has failed with a', request.status_code, request.text, QUERY_COUNT)
-
-
-def graph_commits():
-    """Fetch all-time commits from 2020-01-01 to now and current year commits"""
-    query_count('graph_commits')
-    
-    # Calculate total commits across all years from 2020 to now
-    total_commits = 0
-    current_year = datetime.datetime.now().year
-    year_commits = 0
-    
-    for year in range(2020, current_year + 1):
-        # Set date range for each year
+    if request.status_code == 403:
+        raise Exception('Too many requests in a short amount of time!\n'
+                        'You\'ve hit the non-documented anti-abuse limit!')
+    raise Exception(func_name, ' has failed with a', request.status_code, request.text)
+
+
+def paginate(profile, func_name, query, variables, connection, priority=PRIORITY_FOREGROUND):
+    """
+    Yield the pages of a cursor-paginated connection one at a time as they arrive, in a flat loop so the depth of
+    the history never touches the stack. connection picks the connection (with pageInfo) out of the response data;
+    if it returns None that None is yielded and paging stops
+    """
+    variables = dict(variables)
+    while True:
+        page = connection(simple_request(profile, func_name, query, variables, priority).json()['data'])
+        yield page
+        if page is None or not page['pageInfo']['hasNextPage']:
+            return
+        variables['cursor'] = page['pageInfo']['endCursor']
+
+
+def contribution_windows(start_year=CONTRIB_START_YEAR):
+    """Build one (alias, from, to) window per calendar year from start_year to now"""
+    now = datetime.datetime.now()
+    windows = []
+    for year in range(start_year, now.year + 1):
         from_date = f"{year}-01-01T00:00:00Z"
-        to_date = f"{year}-12-31T23:59:59Z" if year < current_year else datetime.datetime.now().isoformat() + "Z"
-        
-        query = '''
-        query($login: String!, $from: DateTime!, $to: DateTime!) {
-            user(login: $login) {
-                contributionsCollection(from: $from, to: $to) {
-                    contributionCalendar {
+        to_date = f"{year}-12-31T23:59:59Z" if year < now.year else now.isoformat() + "Z"
+        windows.append((f"y{year}", from_date, to_date))
+    return windows
+
+
+def contributions_getter(profile, windows):
+    """
+    Fetch the contribution calendar for every window, aliasing up to CONTRIB_WINDOWS_PER_QUERY
+    contributionsCollection fields into each request. Returns {alias: {'total': int, 'days': [...]}}
+    """
+    contributions = {}
+    for index in range(0, len(windows), CONTRIB_WINDOWS_PER_QUERY):
+        chunk = windows[index:index + CONTRIB_WINDOWS_PER_QUERY]
+        params = ''.join(f', ${alias}_from: DateTime!, ${alias}_to: DateTime!' for alias, _, _ in chunk)
+        fields = ''.join(f'''
+                {alias}: contributionsCollection(from: ${alias}_from, to: ${alias}_to) {{
+                    contributionCalendar {{
                         totalContributions
-                    }
-                }
-            }
-        }'''
-        variables = {'login': USER_NAME, 'from': from_date, 'to': to_date}
-        request = simple_request(graph_commits.__name__, query, variables)
-        data = request.json()['data']['user']['contributionsCollection']
-        commits = int(data['contributionCalendar']['totalContributions'])
-        total_commits += commits
-        
-        # Track current year separately
-        if year == current_year:
-            year_commits = commits
-    
-    return total_commits, year_commits
-
-
-def get_streak_stats():
-    """Fetch contribution streak statistics from all years (2020 to present)"""
-    query_count('graph_commits')
-    
-    current_year = datetime.datetime.now().year
-    all_days = []
-    
-    # Fetch contribution data from 2020 to present
-    for year in range(2020, current_year + 1):
-        from_date = f"{year}-01-01T00:00:00Z"
-        to_date = f"{year}-12-31T23:59:59Z" if year < current_year else datetime.datetime.now().isoformat() + "Z"
-        
-        query = '''
-        query($login: String!, $from: DateTime!, $to: DateTime!) {
-            user(login: $login) {
-                contributionsCollection(from: $from, to: $to) {
-                    contributionCalendar {
-                        weeks {
-                            contributionDays {
+                        weeks {{
+                            contributionDays {{
                                 contributionCount
                                 date
-                            }
-                        }
-                    }
-                }
+                            }}
+                        }}
+                    }}
+                }}''' for alias, _, _ in chunk)
+        query = '''
+        query($login: String!%s) {
+            user(login: $login) {%s
             }
-        }'''
-        variables = {'login': USER_NAME, 'from': from_date, 'to': to_date}
-        request = simple_request(get_streak_stats.__name__, query, variables)
-        
-        weeks = request.json()['data']['user']['contributionsCollection']['contributionCalendar']['weeks']
-        
-        # Flatten days from weeks
-        for week in weeks:
-            all_days.extend(week['contributionDays'])
-    
-    # Sort days by date to ensure proper order
-    all_days.sort(key=lambda x: x['date'])
-    
-    # Calculate streaks
+        }''' % (params, fields)
+        variables = {'login': profile.login}
+        for alias, from_date, to_date in chunk:
+            variables[alias + '_from'] = from_date
+            variables[alias + '_to'] = to_date
+        request = simple_request(profile, contributions_getter.__name__, query, variables)
+        user = request.json()['data']['user']
+        for alias, _, _ in chunk:
+            calendar = user[alias]['contributionCalendar']
+            days = []
+            for week in calendar['weeks']:
+                days.extend(week['contributionDays'])
+            contributions[alias] = {'total': int(calendar['totalContributions']), 'days': days}
+    return contributions
+
+
+def calendar_refresh(profile, store=None):
+    """
+    Bring the on-disk contribution calendar up to date. Closed years are fetched once and folded into the store
+    along with their streak state, so a normal run only downloads the open window (the current year). A store
+    already held in memory is refreshed in place instead of being read back
+    """
+    filename = profile.cache_file('_calendar.json')
+    try:
+        if store is None:
+            with open(filename, 'r') as f:
+                store = json.load(f)
+    except FileNotFoundError:
+        store = {'closed_through': CONTRIB_START_YEAR - 1, 'years': {}, 'days': {}, 'run': 0, 'longest': 0}
+
+    store.pop('open', None)
+    current_year = datetime.datetime.now().year
+    contributions = contributions_getter(profile, contribution_windows(store['closed_through'] + 1))
+    for year in range(store['closed_through'] + 1, current_year):
+        window = contributions[f"y{year}"]
+        days = sorted(window['days'], key=lambda x: x['date'])
+        store['years'][str(year)] = window['total']
+        for day in days:
+            store['days'][day['date']] = day['contributionCount']
+        store['run'], store['longest'] = streak_fold(days, store['run'], store['longest'])
+        store['closed_through'] = year
+    atomic_write(filename, json.dumps(store))
+
+    store['open'] = contributions[f"y{current_year}"]
+    store['open']['days'].sort(key=lambda x: x['date'])
+    return store
+
+
+def streak_fold(days, run, longest):
+    """Extend a (trailing run, longest run) streak state with days sorted by date"""
+    for day in days:
+        if day['contributionCount'] > 0:
+            run += 1
+            longest = max(longest, run)
+        else:
+            run = 0
+    return run, longest
+
+
+def graph_commits(calendar):
+    """All-time contributions since 2020 and the current year's total, from the refreshed calendar"""
+    year_commits = calendar['open']['total']
+    return sum(calendar['years'].values()) + year_commits, year_commits
+
+
+def get_streak_stats(calendar):
+    """Contribution streaks, resuming from the stored streak state of the closed years"""
+    open_days = calendar['open']['days']
     current_streak = 0
-    longest_streak = 0
-    temp_streak = 0
-    
-    # Reverse to check from today backwards for current streak
     today = datetime.datetime.now().date()
-    
-    # Check current streak (must include today or yesterday)
-    for day in reversed(all_days):
+
+    # A calendar served from the stats cache ends at the last run; the days since then had no contributions, so a
+    # gap of more than a day means the current streak is already broken
+    last_date = datetime.datetime.fromisoformat(open_days[-1]['date']).date() if open_days else today
+    streak_broken = (today - last_date).days > 1
+
+    # Check current streak (must include today or yesterday), running back into the closed years if unbroken
+    for day in reversed([] if streak_broken else open_days):
         day_date = datetime.datetime.fromisoformat(day['date'].replace('Z', '+00:00')).date()
         if day_date > today:
             continue
-            
+
         if day['contributionCount'] > 0:
             current_streak += 1
         else:
@@ -133,74 +506,49 @@ def get_streak_stats():
                 continue
             else:
                 break
-    
-    # Calculate longest streak across all years
-    for day in all_days:
-        if day['contributionCount'] > 0:
-            temp_streak += 1
-            longest_streak = max(longest_streak, temp_streak)
-        else:
-            temp_streak = 0
-    
+    else:
+        if not streak_broken:
+            current_streak += calendar['run']
+
+    # Longest streak only needs the open window on top of the stored closed-year state
+    longest_streak = streak_fold(open_days, calendar['run'], calendar['longest'])[1]
+
     return {
         'current_streak': current_streak,
         'longest_streak': longest_streak
     }
 
 
-def graph_repos_stars(count_type, owner_affiliation, cursor=None):
-    query_count('graph_repos_stars')
-    query = '''
-    query ($owner_affiliation: [RepositoryAffiliation], $login: String!, $cursor: String) {
-        user(login: $login) {
-            repositories(first: 100, after: $cursor, ownerAffiliations: $owner_affiliation) {
-                totalCount
-                edges {
-                    node {
-                        ... on Repository {
-                            nameWithOwner
-                            stargazers {
-                                totalCount
-                            }
-                        }
-                    }
-                }
-                pageInfo {
-                    endCursor
-                    hasNextPage
-                }
-            }
-        }
-    }'''
-    variables = {'owner_affiliation': owner_affiliation, 'login': USER_NAME, 'cursor': cursor}
-    request = simple_request(graph_repos_stars.__name__, query, variables)
-    if request.status_code == 200:
-        if count_type == 'repos':
-            return request.json()['data']['user']['repositories']['totalCount']
-        elif count_type == 'stars':
-            return stars_counter(request.json()['data']['user']['repositories']['edges'])
+class LocCrawlError(Exception):
+    """A history page could not be fetched; checkpoint holds the loc_history() arguments to resume from it"""
+
+    def __init__(self, checkpoint, *args):
+        super().__init__(*args)
+        self.checkpoint = checkpoint
 
 
-def recursive_loc(owner, repo_name, data, cache_comment, addition_total=0, deletion_total=0, my_commits=0, cursor=None):
-    query_count('recursive_loc')
+def loc_history(profile, owner, repo_name, addition_total=0, deletion_total=0, my_commits=0, cursor=None, since=None,
+                stop_oid=None, head=None):
+    """
+    Page through the owner's commits on the default branch, newest first; other authors are filtered out by the
+    API. With stop_oid set only commits committed since `since` and above that commit are counted.
+    Returns (additions, deletions, my_commits, head, reached_stop), where head is [oid, committedDate] of the
+    owner's newest commit, or 0 for a repo without a default branch
+    """
     query = '''
-    query ($repo_name: String!, $owner: String!, $cursor: String) {
+    query ($repo_name: String!, $owner: String!, $cursor: String, $since: GitTimestamp, $author_id: ID) {
         repository(name: $repo_name, owner: $owner) {
             defaultBranchRef {
                 target {
                     ... on Commit {
-                        history(first: 100, after: $cursor) {
+                        history(first: 100, after: $cursor, since: $since, author: {id: $author_id}) {
                             totalCount
                             edges {
                                 node {
                                     ... on Commit {
+                                        oid
                                         committedDate
                                     }
-                                    author {
-                                        user {
-                                            id
-                                        }
-                                    }
                                     deletions
                                     additions
                                 }
@@ -215,58 +563,211 @@ def recursive_loc(owner, repo_name, data, cache_comment, addition_total=0, delet
             }
         }
     }'''
-    variables = {'repo_name': repo_name, 'owner': owner, 'cursor': cursor}
-    request = requests.post('https://api.github.com/graphql', json={'query': query, 'variables': variables},
-                            headers=HEADERS)
-    if request.status_code == 200:
-        if request.json()['data']['repository']['defaultBranchRef'] != None:
-            return loc_counter_one_repo(owner, repo_name, data, cache_comment,
-                                        request.json()['data']['repository']['defaultBranchRef']['target']['history'],
-                                        addition_total, deletion_total, my_commits)
-        else:
-            return 0
-    force_close_file(data, cache_comment)
-    if request.status_code == 403:
-        raise Exception(
-            'Too many requests in a short amount of time!\nYou\'ve hit the non-documented anti-abuse limit!')
-    raise Exception('recursive_loc() has failed with a', request.status_code, request.text, QUERY_COUNT)
-
-
-def loc_counter_one_repo(owner, repo_name, data, cache_comment, history, addition_total, deletion_total, my_commits):
-    for node in history['edges']:
-        if node['node']['author']['user'] == OWNER_ID:
-            my_commits += 1
-            addition_total += node['node']['additions']
-            deletion_total += node['node']['deletions']
-
-    if history['edges'] == [] or not history['pageInfo']['hasNextPage']:
-        return addition_total, deletion_total, my_commits
+    variables = {'repo_name': repo_name, 'owner': owner, 'cursor': cursor, 'since': since,
+                 'author_id': profile.owner_id['id']}
+    pages = paginate(profile, loc_history.__name__, query, variables, loc_history_connection, PRIORITY_BACKGROUND)
+    try:
+        for history in pages:
+            if history is None:
+                return 0
+            if head is None and history['edges'] != []:
+                head = [history['edges'][0]['node']['oid'], history['edges'][0]['node']['committedDate']]
+            additions, deletions, commits, reached_stop = loc_counter_one_page(history['edges'], stop_oid)
+            addition_total += additions
+            deletion_total += deletions
+            my_commits += commits
+            if reached_stop:
+                return addition_total, deletion_total, my_commits, head, True
+            cursor = history['pageInfo']['endCursor']
+    except Exception as error:
+        raise LocCrawlError({'addition_total': addition_total, 'deletion_total': deletion_total,
+                             'my_commits': my_commits, 'cursor': cursor, 'since': since, 'stop_oid': stop_oid,
+                             'head': head}, *error.args)
+    return addition_total, deletion_total, my_commits, head, stop_oid is None
+
+
+def loc_history_connection(data):
+    """
+    The history connection of a loc_history() page, or None when the repository, its default branch or the branch
+    target came back null (deleted, emptied or no longer visible), which counts the repo as 0 instead of failing it
+    """
+    ref = data['repository'] and data['repository']['defaultBranchRef']
+    return ref and ref['target'] and ref['target']['history']
+
+
+def loc_counter_one_page(edges, stop_oid):
+    """Sum one history page, stopping before stop_oid. Returns (additions, deletions, commits, reached_stop)"""
+    addition_total = deletion_total = my_commits = 0
+    for node in edges:
+        if node['node']['oid'] == stop_oid:
+            return addition_total, deletion_total, my_commits, True
+        my_commits += 1
+        addition_total += node['node']['additions']
+        deletion_total += node['node']['deletions']
+    return addition_total, deletion_total, my_commits, False
+
+
+def repo_loc_update(profile, owner, repo_name, cached, total_count, checkpoint=None):
+    """
+    Bring one cache entry up to total_count of the owner's commits. Only commits above the cached head are paged
+    in; a full recount happens when there is no head yet, or when the head is gone or the counts disagree
+    (force-push, rewritten history). A checkpoint from an interrupted crawl resumes that crawl at its cursor.
+    Returns [my_commits, additions, deletions, head] or 0 for a repo without a default branch
+    """
+    __, my_commits, addition_total, deletion_total, *head = cached
+    resume = checkpoint or {}
+    if len(head) == 2 and resume.get('stop_oid', head[0]) == head[0]:
+        loc = loc_history(profile, owner, repo_name, **(resume or {'since': head[1], 'stop_oid': head[0]}))
+        if loc != 0 and loc[4] and int(my_commits) + loc[2] == total_count:
+            return [int(my_commits) + loc[2], int(addition_total) + loc[0], int(deletion_total) + loc[1],
+                    loc[3] or head]
+        resume = {}
+    loc = loc_history(profile, owner, repo_name, **resume)
+    if loc == 0:
+        return 0
+    return [loc[2], loc[0], loc[1], loc[3]]
+
+
+def repo_loc_crawl(profile, repo_hash, name_with_owner, cached, total_count, checkpoints, checkpoint_file):
+    """
+    Run repo_loc_update() for one repo, checkpointing the in-flight cursor and partial totals to disk whenever a page
+    fails, and resuming from that checkpoint up to LOC_RESUME_ATTEMPTS more times in this run
+    """
+    owner, repo_name = name_with_owner.split('/')
+    with TRACER.span('repo', name_with_owner, commits=total_count, cached_commits=int(cached[1])) as span:
+        for attempt in range(LOC_RESUME_ATTEMPTS + 1):
+            span['resumes'] = attempt
+            try:
+                loc = repo_loc_update(profile, owner, repo_name, cached, total_count, checkpoints.get(repo_hash))
+            except LocCrawlError as error:
+                with CHECKPOINT_LOCK:
+                    checkpoints[repo_hash] = error.checkpoint
+                    atomic_write(checkpoint_file, json.dumps(checkpoints))
+                if attempt == LOC_RESUME_ATTEMPTS:
+                    raise
+                print('Resuming', name_with_owner, 'in', LOC_RESUME_DELAY, 's after:', *error.args)
+                time.sleep(LOC_RESUME_DELAY)
+            else:
+                with CHECKPOINT_LOCK:
+                    checkpoints.pop(repo_hash, None)
+                return loc
+
+
+def repo_loc_git(profile, name_with_owner, cached):
+    """
+    The git backend's repo_loc_update(): sum the numstat of the profile's commits, matched by its git --author
+    patterns, on the default branch of a local clone. Only commits above the cached head are read, unless that head is
+    no longer an ancestor of the branch (force-push) and everything is recounted. Returns [my_commits, additions,
+    deletions, head] with head as [tip oid, committer date], or 0 for an empty repo
+    """
+    path = shared(('fetch', name_with_owner), git_fetch, name_with_owner, profile.token)
+    tip = subprocess.run(['git', '--git-dir', path, 'log', '-1', '--format=%H %cI'],
+                         capture_output=True, text=True).stdout.split()
+    if not tip:
+        return 0
+    __, my_commits, addition_total, deletion_total, *head = cached
+    if len(head) == 2 and subprocess.run(['git', '--git-dir', path, 'merge-base', '--is-ancestor', head[0], tip[0]],
+                                         capture_output=True).returncode == 0:
+        revisions = head[0] + '..' + tip[0]
+        my_commits, addition_total, deletion_total = int(my_commits), int(addition_total), int(deletion_total)
     else:
-        return recursive_loc(owner, repo_name, data, cache_comment, addition_total, deletion_total, my_commits,
-                             history['pageInfo']['endCursor'])
+        revisions, my_commits, addition_total, deletion_total = tip[0], 0, 0, 0
+    # One pass per repo and range serves every profile that has the repo, each picking out its own authors
+    authors = shared(('numstat', path, revisions), lambda: git_pool().submit(git_numstat, path, revisions).result())
+    for author, (commits, additions, deletions) in authors.items():
+        if any(re.search(pattern, author) for pattern in profile.git_authors):
+            my_commits += commits
+            addition_total += additions
+            deletion_total += deletions
+    return [my_commits, addition_total, deletion_total, tip]
+
+
+def git_fetch(name_with_owner, token):
+    """Clone a repo's default branch into LOC_CLONE_DIR as a bare single-branch clone, or fetch it. Returns the path"""
+    path = os.path.join(LOC_CLONE_DIR, name_with_owner + '.git')
+    basic = base64.b64encode(('x-access-token:' + token).encode('utf-8')).decode('ascii')
+    # The token goes in through the environment, never into the clone's config or the process list
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0', GIT_CONFIG_COUNT='1',
+               GIT_CONFIG_KEY_0='http.' + LOC_GIT_URL + '/.extraheader',
+               GIT_CONFIG_VALUE_0='AUTHORIZATION: basic ' + basic)
+    if os.path.isdir(path):
+        result = subprocess.run(['git', '--git-dir', path, 'fetch', '--quiet', '--force', 'origin', 'HEAD'],
+                                env=env, capture_output=True, text=True)
+        if result.returncode == 0:
+            subprocess.run(['git', '--git-dir', path, 'update-ref', 'HEAD', 'FETCH_HEAD'], check=True)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        result = subprocess.run(['git', 'clone', '--quiet', '--bare', '--single-branch',
+                                 LOC_GIT_URL + '/' + name_with_owner + '.git', path],
+                                env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception('git ' + result.args[1 if result.args[1] == 'clone' else 3] + ' failed for ' +
+                        name_with_owner + ': ' + result.stderr.strip())
+    return path
+
+
+def git_pool():
+    with GIT_POOL_LOCK:
+        if not GIT_POOL:
+            # Spawned rather than forked, since the pipeline's threads are running
+            GIT_POOL.append(ProcessPoolExecutor(max_workers=LOC_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn')))
+        return GIT_POOL[0]
+
+
+def git_numstat(path, revisions):
+    """On the process pool: git log --numstat over revisions as {'Name <email>': [commits, additions, deletions]}"""
+    log = subprocess.Popen(['git', '--git-dir', path, 'log', '--numstat', '--format=@%an <%ae>', revisions],
+                           stdout=subprocess.PIPE, text=True, errors='replace')
+    authors = {}
+    totals = None
+    for line in log.stdout:
+        if line.startswith('@'):
+            totals = authors.setdefault(line[1:].rstrip('\n'), [0, 0, 0])
+            totals[0] += 1
+            continue
+        fields = line.split('\t')
+        if len(fields) == 3 and fields[0] != '-':  # '-' counts are binary files
+            totals[1] += int(fields[0])
+            totals[2] += int(fields[1])
+    if log.wait() != 0:
+        raise Exception('git log failed for ' + path)
+    return authors
+
+
+# Every field the LOC, star and repo count stages read from a repository, plus the pushedAt that keys the language
+# cache; needs $owner_id in the query
+REPO_FIELDS = '''
+    fragment RepoFields on Repository {
+        nameWithOwner
+        owner {
+            login
+        }
+        stargazerCount
+        pushedAt
+        defaultBranchRef {
+            target {
+                ... on Commit {
+                    history(author: {id: $owner_id}) {
+                        totalCount
+                    }
+                }
+            }
+        }
+    }'''
 
 
-def loc_query(owner_affiliation, comment_size=0, force_cache=False, cursor=None, edges=[]):
-    query_count('loc_query')
-    query = '''
-    query ($owner_affiliation: [RepositoryAffiliation], $login: String!, $cursor: String) {
+def inventory_pages(profile, owner_affiliation, inventory):
+    """
+    List every repository once, 100 per page, with REPO_FIELDS. Each page's nodes are added to inventory
+    ({nameWithOwner: node}) and yielded as soon as the page arrives
+    """
+    query = REPO_FIELDS + '''
+    query ($owner_affiliation: [RepositoryAffiliation], $login: String!, $cursor: String, $owner_id: ID) {
         user(login: $login) {
-            repositories(first: 60, after: $cursor, ownerAffiliations: $owner_affiliation) {
-            edges {
-                node {
-                    ... on Repository {
-                        nameWithOwner
-                        defaultBranchRef {
-                            target {
-                                ... on Commit {
-                                    history {
-                                        totalCount
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    }
+            repositories(first: 100, after: $cursor, ownerAffiliations: $owner_affiliation) {
+                nodes {
+                    ...RepoFields
                 }
                 pageInfo {
                     endCursor
@@ -275,109 +776,225 @@ def loc_query(owner_affiliation, comment_size=0, force_cache=False, cursor=None,
             }
         }
     }'''
-    variables = {'owner_affiliation': owner_affiliation, 'login': USER_NAME, 'cursor': cursor}
-    request = simple_request(loc_query.__name__, query, variables)
-    if request.json()['data']['user']['repositories']['pageInfo']['hasNextPage']:
-        edges += request.json()['data']['user']['repositories']['edges']
-        return loc_query(owner_affiliation, comment_size, force_cache,
-                         request.json()['data']['user']['repositories']['pageInfo']['endCursor'], edges)
-    else:
-        return cache_builder(edges + request.json()['data']['user']['repositories']['edges'], comment_size, force_cache)
+    variables = {'owner_affiliation': owner_affiliation, 'login': profile.login, 'cursor': None,
+                 'owner_id': profile.owner_id['id']}
+    for repositories in paginate(profile, inventory_pages.__name__, query, variables,
+                                 lambda data: data['user']['repositories']):
+        nodes = [node for node in repositories['nodes'] if node is not None and node.get('nameWithOwner')]
+        for node in nodes:
+            inventory[node['nameWithOwner']] = node
+        yield nodes
+
+
+def repo_node(profile, name_with_owner):
+    """One repository with REPO_FIELDS, as inventory_pages() lists it, or None if it is gone or out of reach"""
+    query = REPO_FIELDS + '''
+    query ($owner: String!, $repo_name: String!, $owner_id: ID) {
+        repository(owner: $owner, name: $repo_name) {
+            ...RepoFields
+        }
+    }'''
+    owner, repo_name = name_with_owner.split('/')
+    request = graphql_post(profile, repo_node.__name__, query,
+                           {'owner': owner, 'repo_name': repo_name, 'owner_id': profile.owner_id['id']})
+    if request.status_code != 200:
+        raise Exception(repo_node.__name__, ' has failed with a', request.status_code, request.text)
+    return (request.json().get('data') or {}).get('repository')
 
 
-def cache_builder(edges, comment_size, force_cache, loc_add=0, loc_del=0):
-    edges = [e for e in edges if e is not None and e.get('node') is not None]
-    cached = True
-    filename = 'cache/' + hashlib.sha256(USER_NAME.encode('utf-8')).hexdigest() + '.txt'
+def owned_repos(profile, inventory):
+    return [node for node in inventory.values() if node['owner']['login'].lower() == profile.login.lower()]
+
+
+def stars_counter(profile, inventory):
+    return sum(node['stargazerCount'] for node in owned_repos(profile, inventory))
+
+
+def loc_query(profile, pages, comment_size=0, force_cache=False):
+    return cache_builder(profile, (node for page in pages for node in page), comment_size, force_cache)
+
+
+def cache_builder(profile, nodes, comment_size, force_cache, loc_add=0, loc_del=0):
+    filename = profile.cache_file('.txt')
+    checkpoint_file = profile.cache_file('_checkpoint.json')
+    cache_comment, cached_entries = cache_load(filename, comment_size)
     try:
-        with open(filename, 'r') as f:
-            data = f.readlines()
+        with open(checkpoint_file, 'r') as f:
+            checkpoints = json.load(f)
     except FileNotFoundError:
-        data = []
-        if comment_size > 0:
-            for _ in range(comment_size): data.append('This line is a comment block. Write whatever you want here.\n')
-        with open(filename, 'w') as f:
-            f.writelines(data)
-
-    if len(data) - comment_size != len(edges) or force_cache:
-        cached = False
-        flush_cache(edges, filename, comment_size)
-        with open(filename, 'r') as f:
-            data = f.readlines()
-
-    cache_comment = data[:comment_size]
-    data = data[comment_size:]
-    for index in range(len(edges)):
-        repo_hash, commit_count, *__ = data[index].split()
-        if repo_hash == hashlib.sha256(edges[index]['node']['nameWithOwner'].encode('utf-8')).hexdigest():
-            try:
-                if int(commit_count) != edges[index]['node']['defaultBranchRef']['target']['history']['totalCount']:
-                    owner, repo_name = edges[index]['node']['nameWithOwner'].split('/')
-                    loc = recursive_loc(owner, repo_name, data, cache_comment)
-                    data[index] = repo_hash + ' ' + str(
-                        edges[index]['node']['defaultBranchRef']['target']['history']['totalCount']) + ' ' + str(
-                        loc[2]) + ' ' + str(loc[0]) + ' ' + str(loc[1]) + '\n'
-            except TypeError:
-                data[index] = repo_hash + ' 0 0 0 0\n'
-    with open(filename, 'w') as f:
-        f.writelines(cache_comment)
-        f.writelines(data)
-    for line in data:
-        loc = line.split()
-        loc_add += int(loc[3])
-        loc_del += int(loc[4])
+        checkpoints = {}
+    if force_cache:
+        cached_entries = {}
+        checkpoints = {}
+
+    # Entries are keyed by repo hash, so reordered, added or removed repos keep every other repo's counts.
+    # Each repo is checked as its listing page arrives and stale ones start crawling on the pool right away;
+    # results are merged back into entries on this thread only
+    cached = True
+    entries = {}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=LOC_WORKERS) as executor:
+        try:
+            for node in nodes:
+                repo_hash = hashlib.sha256(node['nameWithOwner'].encode('utf-8')).hexdigest()
+                if repo_hash not in cached_entries:
+                    cached = False
+                entries[repo_hash] = cached_entries.get(repo_hash, ['0', '0', '0', '0'])
+                try:
+                    # The listing counts only the owner's commits, which is what the my_commits column holds
+                    total_count = node['defaultBranchRef']['target']['history']['totalCount']
+                except TypeError:
+                    entries[repo_hash] = ['0', '0', '0', '0']
+                    continue
+                if LOC_BACKEND == 'git':
+                    # git --author matching can disagree with GitHub's count, so staleness is judged against the
+                    # listing count stored with the entry instead of the my_commits column
+                    if entries[repo_hash][0] != str(total_count):
+                        futures[executor.submit(TRACER.bind(repo_loc_git), profile, node['nameWithOwner'],
+                                                entries[repo_hash])] = repo_hash, total_count
+                elif int(entries[repo_hash][1]) != total_count:
+                    futures[executor.submit(TRACER.bind(repo_loc_crawl), profile, repo_hash, node['nameWithOwner'],
+                                            entries[repo_hash], total_count, checkpoints,
+                                            checkpoint_file)] = repo_hash, total_count
+            for future in as_completed(futures):
+                repo_hash, total_count = futures[future]
+                entries[repo_hash] = cache_entry(future.result(), total_count)
+        except Exception:
+            # Let the crawls already running finish and keep every one that succeeded, so a failed run only loses
+            # the repos that failed or never started
+            for pending in futures: pending.cancel()
+            wait(futures)
+            for future, (repo_hash, total_count) in futures.items():
+                if not future.cancelled() and future.exception() is None:
+                    entries[repo_hash] = cache_entry(future.result(), total_count)
+            cache_write(filename, cache_comment, dict(cached_entries, **entries))
+            with CHECKPOINT_LOCK:
+                atomic_write(checkpoint_file, json.dumps(checkpoints))
+            print('There was an error while updating the cache file. The file,', filename,
+                  'has had the partial data saved and', checkpoint_file, 'records where to resume.')
+            raise
+    cache_write(filename, cache_comment, entries)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    for entry in entries.values():
+        loc_add += int(entry[2])
+        loc_del += int(entry[3])
     return [loc_add, loc_del, loc_add - loc_del, cached]
 
 
-def flush_cache(edges, filename, comment_size):
-    with open(filename, 'r') as f:
-        data = []
-        if comment_size > 0:
-            data = f.readlines()[:comment_size]
-    with open(filename, 'w') as f:
-        f.writelines(data)
-        for node in edges:
-            if node.get('node') is not None and node['node'].get('nameWithOwner') is not None:
-                f.write(hashlib.sha256(node['node']['nameWithOwner'].encode('utf-8')).hexdigest() + ' 0 0 0 0\n')
+def cache_entry(loc, total_count):
+    """The cache line fields for a finished crawl: [commit_count, my_commits, additions, deletions, *head]"""
+    if loc == 0:
+        return ['0', '0', '0', '0']
+    return [str(total_count)] + [str(value) for value in loc[:3]] + (loc[3] or [])
+
 
+def cache_load(filename, comment_size):
+    """
+    Read the LOC cache into its comment block and a {repo_hash: [commit_count, my_commits, additions, deletions,
+    *head]} dict. Lines may appear in any order
+    """
+    try:
+        with open(filename, 'r') as f:
+            data = f.readlines()
+    except FileNotFoundError:
+        data = ['This line is a comment block. Write whatever you want here.\n'] * comment_size
+    entries = {}
+    for line in data[comment_size:]:
+        fields = line.split()
+        if len(fields) >= 5:
+            entries[fields[0]] = fields[1:]
+    return data[:comment_size], entries
 
-def force_close_file(data, cache_comment):
-    filename = 'cache/' + hashlib.sha256(USER_NAME.encode('utf-8')).hexdigest() + '.txt'
-    with open(filename, 'w') as f:
-        f.writelines(cache_comment)
-        f.writelines(data)
-    print('There was an error while writing to the cache file. The file,', filename,
-          'has had the partial data saved and closed.')
 
+def cache_write(filename, cache_comment, entries):
+    atomic_write(filename, ''.join(cache_comment) +
+                 ''.join(' '.join([repo_hash] + entry) + '\n' for repo_hash, entry in entries.items()))
 
-def stars_counter(data):
-    total_stars = 0
-    for node in data: total_stars += node['node']['stargazers']['totalCount']
-    return total_stars
 
+def atomic_write(filename, text):
+    """Write text to a temp file beside filename and rename it into place, so a killed run never truncates it"""
+    fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.remove(temp_name)
+        raise
+
+
+def committers_rank_getter(profile):
+    """
+    Request every committers.top badge at once and resolve them in priority order: the first endpoint with a rank
+    wins as soon as every endpoint ahead of it has answered, and the slower ones are abandoned. Endpoints that have not
+    answered within RANK_DEADLINE seconds count as failed. The rank is cached in cache/ for RANK_TTL seconds, and a
+    stale cached rank is kept when an endpoint ahead of the result failed
+    """
+    filename = profile.cache_file('_rank.json')
+    username, country = profile.login, profile.country
+    try:
+        with open(filename, 'r') as f:
+            stored = json.load(f)
+        cached = {'rank': stored['rank'], 'fetched_at': float(stored['fetched_at'])}
+        if time.time() - cached['fetched_at'] < RANK_TTL:
+            return cached['rank']
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        # A missing, truncated or hand-edited rank file just means no cached rank
+        cached = None
 
-def committers_rank_getter(username, country='kurdistan'):
-    # Try multiple endpoints to get a valid rank
     endpoints = [
-        f"https://user-badge.committers.top/{country}_private/{username}.svg",
-        f"https://user-badge.committers.top/{country}/{username}.svg",
-        f"https://user-badge.committers.top/worldwide/{username}.svg"
+        f"{COMMITTERS_URL}/{country}_private/{username}.svg",
+        f"{COMMITTERS_URL}/{country}/{username}.svg",
+        f"{COMMITTERS_URL}/worldwide/{username}.svg"
     ]
-    
-    for url in endpoints:
+    results = queue.Queue()
+    for index, url in enumerate(endpoints):
+        # Daemon threads, so an abandoned slow endpoint never holds up the rest of the run or its exit
+        threading.Thread(target=TRACER.bind(committers_rank_fetch), args=(index, url, results), daemon=True).start()
+
+    outcomes = [None] * len(endpoints)
+    rank = None
+    deadline = time.monotonic() + RANK_DEADLINE
+    while rank is None and None in outcomes:
         try:
-            response = requests.get(url, timeout=15)
-            if response.status_code == 200:
-                rank = extract_rank_from_committers_svg(response.text)
-                if rank != 'Unranked':
-                    return rank
-        except:
-            continue
-    
-    return 'Unranked'
+            index, outcome = results.get(timeout=max(0, deadline - time.monotonic()))
+            outcomes[index] = outcome
+            if isinstance(outcome, Exception):
+                print('committers.top rank from', endpoints[index], 'failed:', outcome)
+        except queue.Empty:
+            # Endpoints still retrying after RANK_DEADLINE count as failed and are abandoned
+            outcomes = [TimeoutError('no answer within ' + str(RANK_DEADLINE) + ' s') if outcome is None else outcome
+                        for outcome in outcomes]
+            print('committers.top rank: no answer within', RANK_DEADLINE, 's from',
+                  ', '.join(url for url, outcome in zip(endpoints, outcomes) if isinstance(outcome, TimeoutError)))
+        for outcome in outcomes:
+            if outcome is None:
+                break
+            if not isinstance(outcome, Exception) and outcome != 'Unranked':
+                rank = outcome
+                break
 
+    # Only a result every endpoint ahead of it answered for is cached; if one of them failed it may hold the real
+    # rank, so the stale cached rank is kept instead of being overwritten for RANK_TTL
+    ahead = outcomes if rank is None else outcomes[:outcomes.index(rank)]
+    rank = 'Unranked' if rank is None else rank
+    if any(isinstance(outcome, Exception) for outcome in ahead):
+        return cached['rank'] if cached is not None else rank
+    atomic_write(filename, json.dumps({'rank': rank, 'fetched_at': time.time()}))
+    return rank
 
 
+def committers_rank_fetch(index, url, results):
+    """Fetch one badge and put (index, rank or the exception raised) on the results queue"""
+    try:
+        response = http_request('GET', url, timeout=15)
+        if response.status_code != 200:
+            raise Exception('HTTP ' + str(response.status_code))
+        results.put((index, extract_rank_from_committers_svg(response.text)))
+    except Exception as error:
+        results.put((index, error))
+
 
 def extract_rank_from_committers_svg(svg_text):
     if re.search(r"\bunranked\b", svg_text, flags=re.IGNORECASE):
@@ -405,37 +1022,86 @@ def extract_rank_from_committers_svg(svg_text):
     raise ValueError('Could not extract rank from committers.top SVG')
 
 
-def svg_overwrite(filename, age_data, commit_data, year_commits, rank_data, repo_data, contrib_data, follower_data, loc_data, top_langs, streak_stats):
-    tree = etree.parse(filename)
-    root = tree.getroot()
-    justify_format(root, 'age_data', age_data, 90)
-    justify_format(root, 'commit_data', commit_data, 39)
-    justify_format(root, 'year_commits', year_commits, 0)
-    justify_format(root, 'rank_data', rank_data, 21)
-    justify_format(root, 'repo_data', repo_data, 24)
-    justify_format(root, 'contrib_data', contrib_data, 0)
-    justify_format(root, 'follower_data', follower_data, 36)
-    justify_format(root, 'loc_data', loc_data[2], 49)
-    justify_format(root, 'loc_add', loc_data[0], 0)
-    justify_format(root, 'loc_del', loc_data[1], 0)
+def svg_values(age_data, commit_data, year_commits, rank_data, repo_data, contrib_data, follower_data, loc_data, top_langs, streak_stats):
+    """Format every slot once, dot leaders included, as {element id: text} shared by all templates"""
+    values = {}
+    justify_format(values, 'age_data', age_data, 90)
+    justify_format(values, 'commit_data', commit_data, 39)
+    justify_format(values, 'year_commits', year_commits, 0)
+    justify_format(values, 'rank_data', rank_data, 21)
+    justify_format(values, 'repo_data', repo_data, 24)
+    justify_format(values, 'contrib_data', contrib_data, 0)
+    justify_format(values, 'follower_data', follower_data, 36)
+    justify_format(values, 'loc_data', loc_data[2], 49)
+    justify_format(values, 'loc_add', loc_data[0], 0)
+    justify_format(values, 'loc_del', loc_data[1], 0)
     
     # Update streak stats
-    justify_format(root, 'current_streak', streak_stats['current_streak'], 0)
-    justify_format(root, 'longest_streak', streak_stats['longest_streak'], 0)
+    justify_format(values, 'current_streak', streak_stats['current_streak'], 0)
+    justify_format(values, 'longest_streak', streak_stats['longest_streak'], 0)
     
     # Update top languages
     for i, lang in enumerate(top_langs[:5]):
-        justify_format(root, f'lang{i+1}_name', lang['name'], 0)
-        justify_format(root, f'lang{i+1}_pct', f"{lang['percentage']}%", 0)
-    
-    tree.write(filename, encoding='utf-8', xml_declaration=True)
-
-
-def justify_format(root, element_id, new_text, total_width):
+        justify_format(values, f'lang{i+1}_name', lang['name'], 0)
+        justify_format(values, f'lang{i+1}_pct', f"{lang['percentage']}%", 0)
+    return values
+
+
+def svg_overwrite(filenames, values):
+    """Write one computed value set into every template, each parsed and indexed at most once"""
+    for filename in filenames:
+        tree, index = svg_template(filename)
+        for element_id, new_text in values.items():
+            if element_id in index:
+                index[element_id].text = new_text
+        tree.write(filename, encoding='utf-8', xml_declaration=True)
+        SVG_TEMPLATES[filename] = os.stat(filename).st_mtime_ns, tree, index
+
+
+def svg_render(profile, values):
+    """
+    svg_overwrite() only if the stat bundle or the templates differ from the last render. The fingerprint covers the
+    values and the rendered files as they are on disk, so an edited template is still picked up. Returns whether
+    anything was written
+    """
+    filename = profile.cache_file('_render.txt')
+    try:
+        with open(filename, 'r') as f:
+            last_fingerprint = f.read().strip()
+    except FileNotFoundError:
+        last_fingerprint = None
+    if render_fingerprint(profile.templates, values) == last_fingerprint:
+        return False
+    svg_overwrite(profile.templates, values)
+    atomic_write(filename, render_fingerprint(profile.templates, values) + '\n')
+    return True
+
+
+def render_fingerprint(filenames, values):
+    fingerprint = hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8'))
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            fingerprint.update(hashlib.sha256(f.read()).digest())
+    return fingerprint.hexdigest()
+
+
+def svg_template(filename):
+    """
+    Parsed tree and {id: element} index of a template, from a single //*[@id] scan. Kept in SVG_TEMPLATES and only
+    reparsed when the file changes on disk behind our back
+    """
+    mtime = os.stat(filename).st_mtime_ns
+    if filename not in SVG_TEMPLATES or SVG_TEMPLATES[filename][0] != mtime:
+        tree = etree.parse(filename)
+        SVG_TEMPLATES[filename] = mtime, tree, {element.get('id'): element for element in tree.xpath('//*[@id]')}
+    return SVG_TEMPLATES[filename][1:]
+
+
+def justify_format(values, element_id, new_text, total_width):
     if isinstance(new_text, int):
         new_text = f"{'{:,}'.format(new_text)}"
     new_text = str(new_text)
-    find_and_replace(root, element_id, new_text)
+    values[element_id] = new_text
 
     if total_width > 0:
         dots_needed = total_width - len(new_text)
@@ -447,107 +1113,463 @@ def justify_format(root, element_id, new_text, total_width):
             dot_string = '. '
         else:
             dot_string = ' ' + ('.' * (dots_needed - 2)) + ' '
-        find_and_replace(root, f"{element_id}_dots", dot_string)
-
+        values[f"{element_id}_dots"] = dot_string
 
-def find_and_replace(root, element_id, new_text):
-    element = root.find(f".//*[@id='{element_id}']")
-    if element is not None:
-        element.text = new_text
 
-
-def user_getter(username):
-    query_count('user_getter')
+def summary_getter(profile):
+    """
+    The run's probe: account id and follower count plus a fingerprint of what the expensive stages read, namely this
+    year's contribution total, the repo count, the latest pushedAt and the star total of the top 100 owned repos,
+    all in a single query
+    """
     query = '''
-    query($login: String!){
+    query($login: String!, $from: DateTime!, $to: DateTime!){
         user(login: $login) {
             id
-            createdAt
-        }
-    }'''
-    variables = {'login': username}
-    request = simple_request(user_getter.__name__, query, variables)
-    return {'id': request.json()['data']['user']['id']}, request.json()['data']['user']['createdAt']
-
-
-def follower_getter(username):
-    query_count('follower_getter')
-    query = '''
-    query($login: String!){
-        user(login: $login) {
             followers {
                 totalCount
             }
-        }
-    }'''
-    request = simple_request(follower_getter.__name__, query, {'login': username})
-    return int(request.json()['data']['user']['followers']['totalCount'])
-
-
-def top_languages_getter(username):
-    query_count('follower_getter')
-    query = '''
-    query($login: String!) {
-        user(login: $login) {
-            repositories(first: 100, ownerAffiliations: OWNER, orderBy: {field: STARGAZERS, direction: DESC}) {
+            contributionsCollection(from: $from, to: $to) {
+                contributionCalendar {
+                    totalContributions
+                }
+            }
+            recent: repositories(first: 1, ownerAffiliations: [OWNER, COLLABORATOR, ORGANIZATION_MEMBER],
+                                 orderBy: {field: PUSHED_AT, direction: DESC}) {
+                totalCount
                 nodes {
-                    languages(first: 10, orderBy: {field: SIZE, direction: DESC}) {
-                        edges {
-                            size
-                            node {
-                                name
-                                color
-                            }
-                        }
-                    }
+                    pushedAt
+                }
+            }
+            starred: repositories(first: 100, ownerAffiliations: OWNER, orderBy: {field: STARGAZERS, direction: DESC}) {
+                nodes {
+                    stargazerCount
                 }
             }
         }
     }'''
-    request = simple_request(top_languages_getter.__name__, query, {'login': username})
-    
-    # Aggregate language data
-    lang_totals = {}
-    lang_colors = {}
-    
-    for repo in request.json()['data']['user']['repositories']['nodes']:
-        for edge in repo['languages']['edges']:
-            lang_name = edge['node']['name']
-            lang_size = edge['size']
-            lang_color = edge['node']['color'] or '#858585'
-            
-            if lang_name in lang_totals:
-                lang_totals[lang_name] += lang_size
-            else:
-                lang_totals[lang_name] = lang_size
-                lang_colors[lang_name] = lang_color
-    
-    # Sort by size and get top 5
-    sorted_langs = sorted(lang_totals.items(), key=lambda x: x[1], reverse=True)[:5]
+    __, from_date, to_date = contribution_windows()[-1]
+    request = simple_request(profile, summary_getter.__name__, query,
+                             {'login': profile.login, 'from': from_date, 'to': to_date})
+    user = request.json()['data']['user']
+    return {
+        'owner_id': {'id': user['id']},
+        'followers': int(user['followers']['totalCount']),
+        'fingerprint': {
+            'contributions': [from_date[:4],
+                              user['contributionsCollection']['contributionCalendar']['totalContributions']],
+            'repos': [user['recent']['totalCount'], [node['pushedAt'] for node in user['recent']['nodes']],
+                      sum(node['stargazerCount'] for node in user['starred']['nodes'])]
+        }
+    }
+
+
+def stats_load(profile):
+    """The stage results and fingerprint stored by the last run, as {'fingerprint': {...}, 'stages': {...}}"""
+    try:
+        with open(profile.cache_file('_stats.json'), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'fingerprint': {}, 'stages': {}}
+
+
+def stats_save(profile, fingerprint, stages):
+    """
+    Store the stage results with the fingerprint they were computed under. The calendar keeps only what
+    graph_commits() and get_streak_stats() read; its closed-year days already live in _calendar.json
+    """
+    stages = dict(stages, calendar={key: stages['calendar'][key] for key in ['years', 'run', 'longest', 'open']})
+    atomic_write(profile.cache_file('_stats.json'), json.dumps({'fingerprint': fingerprint, 'stages': stages}))
+
+
+def cached_stage(profile, name, key, summary, stored, funct, *args):
+    """
+    Serve a stage from the stored stats when the fingerprint entry its inputs depend on is unchanged since they were
+    stored, otherwise run it. Served stage names are collected in profile.skipped_stages
+    """
+    if not FORCE_REFRESH and name in stored['stages'] and stored['fingerprint'].get(key) == summary['fingerprint'][key]:
+        profile.skipped_stages.append(name)
+        TRACER.annotate(cached=True)
+        return stored['stages'][name]
+    return funct(*args)
+
+
+def top_languages_getter(profile, inventory):
+    """
+    Top 5 languages by size over every repo the user owns. Each repo's sizes are cached with the pushedAt they were
+    read at and only repos pushed to since then are fetched again; the running totals are adjusted by what those
+    repos, and any repo no longer owned, took out and put back
+    """
+    filename = profile.cache_file('_languages.json')
+    try:
+        with open(filename, 'r') as f:
+            store = json.load(f)
+    except FileNotFoundError:
+        store = {'repos': {}, 'colors': {}, 'totals': {}}
+    repos = {node['nameWithOwner']: node['pushedAt'] for node in owned_repos(profile, inventory)}
+    stale = [name for name, pushed_at in repos.items() if name not in store['repos'] or
+             store['repos'][name]['pushed_at'] != pushed_at]
+    gone = [name for name in store['repos'] if name not in repos]
+
+    lang_totals = store['totals']
+    for name in gone + stale:
+        for lang_name, lang_size in store['repos'].pop(name, {'sizes': {}})['sizes'].items():
+            lang_totals[lang_name] -= lang_size
+            if lang_totals[lang_name] <= 0:
+                del lang_totals[lang_name]
+    if stale:
+        sizes, colors = languages_getter(profile, stale)
+        store['colors'].update(colors)
+        for name in stale:
+            store['repos'][name] = {'pushed_at': repos[name], 'sizes': sizes[name]}
+            for lang_name, lang_size in sizes[name].items():
+                lang_totals[lang_name] = lang_totals.get(lang_name, 0) + lang_size
+    if stale or gone:
+        atomic_write(filename, json.dumps(store))
+
+    # Top 5 by size from a heap, no full sort of every language
+    top_langs = heapq.nlargest(5, lang_totals.items(), key=lambda x: x[1])
     total_size = sum(lang_totals.values())
-    
+
     # Calculate percentages
     result = []
-    for lang, size in sorted_langs:
+    for lang, size in top_langs:
         percentage = (size / total_size * 100) if total_size > 0 else 0
         result.append({
             'name': lang,
             'percentage': round(percentage, 1),
-            'color': lang_colors[lang]
+            'color': store['colors'][lang]
         })
-    
-    return result
-
 
-def query_count(funct_id):
-    global QUERY_COUNT
-    QUERY_COUNT[funct_id] += 1
+    return result
 
 
-def perf_counter(funct, *args):
+def languages_getter(profile, names):
+    """
+    Language sizes of each repo in names, aliasing up to LANGUAGES_PER_QUERY repository fields into each request.
+    Returns ({nameWithOwner: {language: size}}, {language: color}); a repo deleted since the listing has no sizes
+    """
+    sizes, colors = {}, {}
+    for index in range(0, len(names), LANGUAGES_PER_QUERY):
+        chunk = names[index:index + LANGUAGES_PER_QUERY]
+        params = ', '.join(f'$o{alias}: String!, $n{alias}: String!' for alias in range(len(chunk)))
+        fields = ''.join(f'''
+            r{alias}: repository(owner: $o{alias}, name: $n{alias}) {{
+                languages(first: 100, orderBy: {{field: SIZE, direction: DESC}}) {{
+                    edges {{
+                        size
+                        node {{
+                            name
+                            color
+                        }}
+                    }}
+                }}
+            }}''' for alias in range(len(chunk)))
+        query = '''
+        query(%s) {%s
+        }''' % (params, fields)
+        variables = {}
+        for alias, name in enumerate(chunk):
+            variables[f'o{alias}'], variables[f'n{alias}'] = name.split('/')
+        data = simple_request(profile, languages_getter.__name__, query, variables).json()['data'] or {}
+        for alias, name in enumerate(chunk):
+            repository = data.get(f'r{alias}')
+            sizes[name] = {}
+            for edge in repository['languages']['edges'] if repository else []:
+                sizes[name][edge['node']['name']] = edge['size']
+                colors[edge['node']['name']] = edge['node']['color'] or '#858585'
+    return sizes, colors
+
+
+def perf_counter(name, funct, *args):
+    with TRACER.span('stage', name) as span:
+        funct_return = funct(*args)
+    return funct_return, span['duration']
+
+
+def run_pipeline(stages):
+    """
+    Run a DAG of stages on a thread pool. stages maps a name to (function, dependency names); each function is
+    called with its dependencies' results as soon as they are all available. Returns ({name: result},
+    {name: seconds}, wall seconds)
+    """
     start = time.perf_counter()
-    funct_return = funct(*args)
-    return funct_return, time.perf_counter() - start
+    results, timings = {}, {}
+    pending = dict(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while pending or running:
+            for name, (funct, dependencies) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    running[executor.submit(TRACER.bind(perf_counter), name, funct,
+                                            *[results[dep] for dep in dependencies])] = name
+                    del pending[name]
+            if not running:
+                raise Exception('Pipeline stages have unmet dependencies:', list(pending))
+            done, __ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], timings[name] = future.result()
+    return results, timings, time.perf_counter() - start
+
+
+def loc_stage(profile, summary, inventory):
+    """
+    LOC crawl over the streaming repo inventory, once the summary has provided the owner id, plus the repo counts
+    and star total read from the finished inventory
+    """
+    profile.owner_id = summary['owner_id']
+    total_loc = loc_query(profile, inventory_pages(profile, ['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'],
+                                                   inventory), 7)
+    return {'total_loc': total_loc, 'repos': len(owned_repos(profile, inventory)), 'contributed': len(inventory),
+            'stars': stars_counter(profile, inventory)}
+
+
+def render_profile(profile):
+    """
+    Run the stat pipeline for one profile and render its templates. Each stage starts as soon as the stages it names
+    have finished. The summary probe comes first: the calendar, LOC and language stages are served from the last
+    run's stats when the fingerprint inputs they read are unchanged, so a quiet day costs the probe alone. LOC
+    queries still run at background priority. Returns (results, timings, wall seconds, whether the SVGs changed)
+    """
+    stored = stats_load(profile)
+    inventory = {}
+    with TRACER.span('profile', profile.login):
+        results, timings, wall_time = run_pipeline({
+            'summary': (lambda: summary_getter(profile), []),
+            'age': (lambda: daily_readme(profile.birthday), []),
+            'calendar': (lambda summary: cached_stage(profile, 'calendar', 'contributions', summary, stored,
+                                                      calendar_refresh, profile), ['summary']),
+            'commits': (graph_commits, ['calendar']),
+            'streak': (get_streak_stats, ['calendar']),
+            'rank': (lambda: committers_rank_getter(profile), []),
+            'loc': (lambda summary: cached_stage(profile, 'loc', 'repos', summary, stored, loc_stage, profile,
+                                                 summary, inventory), ['summary']),
+            'languages': (lambda summary, loc: cached_stage(profile, 'languages', 'repos', summary, stored,
+                                                            top_languages_getter, profile, inventory),
+                          ['summary', 'loc'])
+        })
+    stats_save(profile, results['summary']['fingerprint'],
+               {name: results[name] for name in ['calendar', 'loc', 'languages']})
+
+    commit_data, year_commits = results['commits']
+    loc = results['loc']
+    rendered = svg_render(profile, svg_values(results['age'], commit_data, year_commits, results['rank'],
+                                              loc['repos'], loc['contributed'], results['summary']['followers'],
+                                              ['{:,}'.format(value) for value in loc['total_loc'][:-1]],
+                                              results['languages'], results['streak']))
+    return results, timings, wall_time, rendered
+
+
+def batch_profiles(filename):
+    """
+    The profiles of a BATCH_FILE. An entry without templates renders into <login>_dark_mode.svg and
+    <login>_light_mode.svg, copied from TEMPLATES the first time, and no template file may belong to two profiles
+    """
+    with open(filename, 'r') as f:
+        entries = json.load(f)
+    profiles = []
+    owners = {}  # real template path -> login
+    for entry in entries:
+        # Profiles render in parallel, so each needs template files of its own
+        templates = entry.get('templates')
+        if not templates:
+            templates = [entry['login'] + '_' + template for template in TEMPLATES]
+            for source, template in zip(TEMPLATES, templates):
+                if not os.path.exists(template):
+                    shutil.copyfile(source, template)
+        for template in templates:
+            owner = owners.setdefault(os.path.realpath(template), entry['login'])
+            if owner != entry['login']:
+                raise ValueError(f"{filename}: {entry['login']} and {owner} both render into {template}")
+        profiles.append(Profile(entry['login'], os.environ[entry.get('token_env', 'ACCESS_TOKEN')], entry['birthday'],
+                                templates, **{key: entry[key] for key in ['country', 'git_authors'] if key in entry}))
+    return profiles
+
+
+class RefreshService:
+    """
+    Serve mode for one profile. The stat bundle, repo inventory and calendar stay in memory; a worker thread runs
+    refresh jobs one at a time (a stat whose TTL in STAT_TTLS ran out, or a single pushed repo) and re-renders the
+    templates after each, keeping the rendered SVGs in memory for the HTTP endpoint
+    """
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.stats = {}
+        self.refreshed = {}  # stat -> time of its last refresh
+        self.inventory = {}
+        self.calendar = None
+        self.svgs = {}  # template basename -> rendered bytes
+        self.jobs = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def request(self, job):
+        """Queue a refresh of a stat name or of ('repo', nameWithOwner), unless it is already waiting"""
+        with self.lock:
+            if job in self.pending:
+                return
+            self.pending.add(job)
+        self.jobs.put(job)
+
+    def run(self):
+        while True:
+            try:
+                job = self.jobs.get(timeout=5)
+            except queue.Empty:
+                for name, ttl in STAT_TTLS.items():
+                    if time.time() - self.refreshed.get(name, 0) >= ttl:
+                        self.request(name)
+                continue
+            with self.lock:
+                self.pending.discard(job)
+            with TRACER.span('refresh', str(job), user=self.profile.login) as span:
+                try:
+                    self.refresh(job)
+                    self.render()
+                except Exception as error:
+                    print(self.profile.login, 'refresh of', job, 'failed:', error)
+                    if job in STAT_TTLS:
+                        self.refreshed[job] = time.time() - STAT_TTLS[job] + STAT_RETRY
+            spans = TRACER.drain(span)
+            if TRACE_FILE:
+                with open(TRACE_FILE, 'a') as f:
+                    f.write(json.dumps({'user': self.profile.login, 'job': str(job), 'spans': spans}) + '\n')
+
+    def refresh(self, job):
+        profile = self.profile
+        if job == 'summary':
+            self.stats['summary'] = summary_getter(profile)
+            profile.owner_id = self.stats['summary']['owner_id']
+        elif job == 'calendar':
+            self.calendar = calendar_refresh(profile, self.calendar)
+            self.stats['commits'] = graph_commits(self.calendar)
+            self.stats['streak'] = get_streak_stats(self.calendar)
+        elif job == 'rank':
+            self.stats['rank'] = committers_rank_getter(profile)
+        elif job == 'loc':
+            shared_forget()
+            inventory = {}
+            self.stats['loc'] = loc_stage(profile, self.stats['summary'], inventory)
+            self.stats['languages'] = top_languages_getter(profile, inventory)
+            self.inventory = inventory
+        else:
+            # A push: re-read that repo's listing entry, then cache_builder() only crawls what went stale
+            node = repo_node(profile, job[1])
+            if node is None:
+                return
+            shared_forget()
+            self.inventory[job[1]] = node
+            total_loc = cache_builder(profile, list(self.inventory.values()), 7, False)
+            self.stats['loc'] = {'total_loc': total_loc, 'repos': len(owned_repos(profile, self.inventory)),
+                                 'contributed': len(self.inventory), 'stars': stars_counter(profile, self.inventory)}
+            self.stats['languages'] = top_languages_getter(profile, self.inventory)
+            return
+        self.refreshed[job] = time.time()
+
+    def render(self):
+        if not all(name in self.stats for name in ['summary', 'commits', 'streak', 'rank', 'loc', 'languages']):
+            return
+        commit_data, year_commits = self.stats['commits']
+        loc = self.stats['loc']
+        svg_render(self.profile, svg_values(daily_readme(self.profile.birthday), commit_data, year_commits,
+                                            self.stats['rank'], loc['repos'], loc['contributed'],
+                                            self.stats['summary']['followers'],
+                                            ['{:,}'.format(value) for value in loc['total_loc'][:-1]],
+                                            self.stats['languages'], self.stats['streak']))
+        for filename in self.profile.templates:
+            with open(filename, 'rb') as f:
+                self.svgs[os.path.basename(filename)] = f.read()
+
+
+class CardHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /<login>/<template> (or /<template> with a single profile) answers from memory. POST /refresh takes a GitHub
+    push event and queues a LOC refresh of the pushed repo for every profile that lists it
+    """
+    services = {}  # login -> RefreshService
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) == 1 and len(self.services) == 1:
+            parts = list(self.services) + parts
+        service = self.services.get(parts[0]) if len(parts) == 2 else None
+        if service is None or parts[1] not in {os.path.basename(name) for name in service.profile.templates}:
+            return self.reply(404, b'Not found')
+        svg = service.svgs.get(parts[1])
+        if svg is None:
+            return self.reply(503, b'Not rendered yet', [('Retry-After', '30')])
+        etag = '"' + hashlib.sha256(svg).hexdigest()[:32] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(304, b'', [('ETag', etag)])
+        self.reply(200, svg, [('Content-Type', 'image/svg+xml'), ('Cache-Control', 'no-cache'), ('ETag', etag)])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.split('?')[0].rstrip('/') != '/refresh':
+            return self.reply(404, b'Not found')
+        if WEBHOOK_SECRET:
+            signature = 'sha256=' + hmac.new(WEBHOOK_SECRET.encode('utf-8'), body, hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(signature, self.headers.get('X-Hub-Signature-256', '')):
+                return self.reply(401, b'Bad signature')
+        if self.headers.get('X-GitHub-Event', 'push') != 'push':
+            return self.reply(204, b'')
+        try:
+            name_with_owner = json.loads(body)['repository']['full_name']
+        except (ValueError, KeyError, TypeError):
+            return self.reply(400, b'Expected a push event')
+        queued = []
+        for login, service in self.services.items():
+            if name_with_owner in service.inventory:
+                service.request(('repo', name_with_owner))
+            elif name_with_owner.split('/')[0].lower() == login.lower():
+                service.request('loc')  # a repo the last listing did not have yet
+            else:
+                continue
+            queued.append(login)
+        self.reply(202, json.dumps({'queued': queued}).encode('utf-8'), [('Content-Type', 'application/json')])
+
+
+def serve(profiles):
+    """Serve mode: one RefreshService per profile behind a threaded HTTP server, until interrupted"""
+    for profile in profiles:
+        service = CardHandler.services[profile.login] = RefreshService(profile)
+        for filename in profile.templates:
+            with open(filename, 'rb') as f:
+                service.svgs[os.path.basename(filename)] = f.read()
+        threading.Thread(target=service.run, name='refresh-' + profile.login, daemon=True).start()
+    server = http.server.ThreadingHTTPServer((SERVE_HOST, SERVE_PORT), CardHandler)
+    print('Serving', len(profiles), 'profile(s) on http://%s:%d/' % server.server_address[:2])
+    server.serve_forever()
+
+
+def api_totals():
+    """Print the GraphQL calls, points and HTTP traffic of the run, from the trace"""
+    queries = TRACER.totals('query')
+    print('Total GitHub GraphQL API calls:', '{:>3}'.format(sum(count for count, __, __ in queries.values())))
+    print('GraphQL points spent:', sum(scheduler.spent for scheduler in SCHEDULERS.values()),
+          'remaining:', ', '.join(str(scheduler.remaining) for scheduler in SCHEDULERS.values()))
+    for funct_name, (count, seconds, cost) in queries.items():
+        print('{:<28}'.format('   ' + funct_name + ':'), '{:>6}'.format(count),
+              '{:>11}'.format('%.4f' % seconds + ' s'), '{:>6}'.format(cost), 'pts')
+    with TRACER.lock:
+        requests_sent = [span for span in TRACER.spans if span['kind'] == 'http' and 'duration' in span]
+    sized = [span['bytes_transferred'] for span in requests_sent if 'bytes_transferred' in span]
+    print('HTTP requests:', len(requests_sent), ' transferred:', '{:,}'.format(sum(sized)), 'bytes',
+          '(%d of unknown size)' % (len(requests_sent) - len(sized)) if len(sized) < len(requests_sent) else '',
+          ' retries:', sum(span['retries'] for span in requests_sent))
 
 
 def formatter(query_type, difference, funct_return=False, whitespace=0):
@@ -560,38 +1582,52 @@ def formatter(query_type, difference, funct_return=False, whitespace=0):
 
 
 if __name__ == '__main__':
-    print('Calculation times:')
-    user_data, user_time = perf_counter(user_getter, USER_NAME)
-    OWNER_ID, acc_date = user_data
-    formatter('account data', user_time)
-    age_data, age_time = perf_counter(daily_readme, datetime.datetime(2001, 4, 21))
-    formatter('age calculation', age_time)
-    total_loc, loc_time = perf_counter(loc_query, ['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'], 7)
-    formatter('LOC (cached)', loc_time) if total_loc[-1] else formatter('LOC (no cache)', loc_time)
-
-    commit_result, commit_time = perf_counter(graph_commits)
-    commit_data, year_commits = commit_result
-    rank_data, rank_time = perf_counter(committers_rank_getter, USER_NAME)
-    repo_data, repo_time = perf_counter(graph_repos_stars, 'repos', ['OWNER'])
-    contrib_data, contrib_time = perf_counter(graph_repos_stars, 'repos',
-                                              ['OWNER', 'COLLABORATOR', 'ORGANIZATION_MEMBER'])
-    follower_data, follower_time = perf_counter(follower_getter, USER_NAME)
-    top_langs, lang_time = perf_counter(top_languages_getter, USER_NAME)
-    streak_stats, streak_time = perf_counter(get_streak_stats)
-
-    for index in range(len(total_loc) - 1): total_loc[index] = '{:,}'.format(total_loc[index])
-
-    svg_overwrite('dark_mode.svg', age_data, commit_data, year_commits, rank_data, repo_data, contrib_data, follower_data,
-                  total_loc[:-1], top_langs, streak_stats)
-    svg_overwrite('light_mode.svg', age_data, commit_data, year_commits, rank_data, repo_data, contrib_data, follower_data,
-                  total_loc[:-1], top_langs, streak_stats)
-
-    print('\033[F\033[F\033[F\033[F\033[F\033[F\033[F\033[F',
-          '{:<21}'.format('Total function time:'),
-          '{:>11}'.format(
-              '%.4f' % (user_time + age_time + loc_time + commit_time + rank_time + repo_time + contrib_time)),
-          ' s \033[E\033[E\033[E\033[E\033[E\033[E\033[E\033[E', sep='')
-
-    print('Total GitHub GraphQL API calls:', '{:>3}'.format(sum(QUERY_COUNT.values())))
-    for funct_name, count in QUERY_COUNT.items(): print('{:<28}'.format('   ' + funct_name + ':'),
-                                                        '{:>6}'.format(count))
+    if BATCH_FILE:
+        profiles = batch_profiles(BATCH_FILE)
+    else:
+        profiles = [Profile(USER_NAME, os.environ['ACCESS_TOKEN'], '2001-04-21', git_authors=LOC_GIT_AUTHORS)]
+    if SERVE_PORT:
+        serve(profiles)
+    if TRACE_FILE:
+        # Registered first so the trace is written even when a stage raises
+        atexit.register(lambda: TRACER.dump(TRACE_FILE, users=[profile.login for profile in profiles],
+                                            points_spent=sum(scheduler.spent for scheduler in SCHEDULERS.values())))
+
+    if not BATCH_FILE:
+        print('Calculation times:')
+        profile = profiles[0]
+        results, timings, wall_time, rendered = render_profile(profile)
+        labels = {'summary': 'account data', 'age': 'age calculation', 'calendar': 'contributions',
+                  'commits': 'commit totals', 'streak': 'streaks', 'rank': 'committers rank',
+                  'loc': 'LOC (cached)' if results['loc']['total_loc'][-1] or 'loc' in profile.skipped_stages
+                  else 'LOC (no cache)', 'languages': 'languages'}
+        for name, label in labels.items(): formatter(label, timings[name])
+        if profile.skipped_stages:
+            print('Unchanged since the last run, served from cache:', ', '.join(profile.skipped_stages))
+        if not rendered:
+            print('Stats unchanged since the last render, SVGs left untouched')
+        print('{:<21}'.format('Total function time:'), '{:>11}'.format('%.4f' % sum(timings.values())), ' s', sep='')
+        print('{:<21}'.format('Total wall time:'), '{:>11}'.format('%.4f' % wall_time), ' s', sep='')
+    else:
+        # Profiles share the session, the request slots and the scheduler of their token; the git backend also
+        # shares each repo's fetch and numstat pass between them
+        start = time.perf_counter()
+        failures = []
+        with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+            futures = {executor.submit(TRACER.bind(render_profile), profile): profile for profile in profiles}
+            for future in as_completed(futures):
+                profile = futures[future]
+                try:
+                    results, timings, wall_time, rendered = future.result()
+                except Exception as error:
+                    failures.append(error)
+                    print('{:<24}'.format(profile.login), 'failed:', error)
+                    continue
+                print('{:<24}'.format(profile.login), '{:>11}'.format('%.4f' % wall_time), ' s  ',
+                      'rendered' if rendered else 'unchanged', sep='', end='')
+                print('  (cached: ' + ', '.join(profile.skipped_stages) + ')' if profile.skipped_stages else '')
+        print('{:<24}'.format('Total wall time:'), '{:>11}'.format('%.4f' % (time.perf_counter() - start)), ' s',
+              sep='')
+        if failures:
+            raise failures[0]
+    api_totals()